@@ -4,128 +4,436 @@ import json
 import re
 import subprocess
 import socket
-import paho.mqtt.client as mqtt
+import shlex
 import time
 import threading
 import select
-from collections import deque
+import signal
+import selectors
+import hashlib
+import ctypes
+import functools
+import fnmatch
+
+# orjson заметно быстрее разбирает и сериализует JSON; без него используем
+# stdlib с тем же компактным форматом вывода
+try:
+    from orjson import dumps as _jdumps, loads as _jloads
+except ImportError:
+    _jloads = json.loads
+    _jdumps = functools.partial(json.dumps, separators=(",", ":"), ensure_ascii=False)
+
+# Команды MPV, которые разрешено пересылать из MQTT (по первому слову).
+# Всё остальное, в том числе run/subprocess/loadfile, отбрасывается без
+# обращения к IPC сокету. Для команд, меняющих свойства, имя свойства
+# дополнительно проверяется по _MPV_PROPERTIES
+_MPV_COMMANDS = frozenset({
+    "cycle", "cycle-values", "set", "add", "multiply",
+    "set_property", "get_property",
+    "seek", "revert-seek", "frame-step", "frame-back-step",
+    "playlist-next", "playlist-prev", "playlist-play-index",
+    "playlist-shuffle", "playlist-unshuffle",
+    "sub-seek", "sub-step", "show-text", "show-progress",
+    "quit",
+})
+
+# Команды, первым аргументом которых идёт имя изменяемого свойства
+_MPV_PROPERTY_COMMANDS = frozenset({
+    "cycle", "cycle-values", "set", "add", "multiply", "set_property",
+})
+
+# Свойства, которые можно менять из MQTT. Пути (log-file, stream-record,
+# screenshot-directory и т.п.) сюда не входят
+_MPV_PROPERTIES = frozenset({
+    "pause", "volume", "mute", "speed",
+    "sid", "aid", "vid", "sub-visibility", "sub-delay", "audio-delay",
+    "sub-scale", "sub-pos", "secondary-sid",
+    "fullscreen", "loop-file", "loop-playlist",
+    "time-pos", "percent-pos", "playlist-pos", "chapter",
+    "osd-level", "brightness", "contrast", "saturation", "gamma",
+})
+
+# inotify из libc - чтобы просыпаться сразу при создании сокета MPV
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+# IN_CLOEXEC определён как O_CLOEXEC, значение зависит от архитектуры
+_IN_CLOEXEC = os.O_CLOEXEC
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+except (OSError, AttributeError):
+    _inotify_init1 = None
+
+# Разбивает имя на текстовые и числовые части для естественной сортировки
+_DIGIT_RE = re.compile(r'(\d+)')
+
+
+@functools.lru_cache(maxsize=65536)
+def _nat_key(name):
+    """
+    Ключ естественной сортировки (natural sort) для строки.
+    split с группой всегда чередует текст и числа, поэтому числа стоят
+    на нечётных позициях и преобразуются одним срезом без проверки isdigit.
+    Ключи кэшируются между пересканированиями, поэтому возвращается
+    неизменяемый tuple
+    """
+    parts = _DIGIT_RE.split(name.lower())
+    parts[1::2] = map(int, parts[1::2])
+    return tuple(parts)
+
+
+def _entry_nat_key(entry):
+    return _nat_key(entry.name)
+
+
+def _stat_sig(st):
+    """(mtime, size, inode) каталога - меняется при добавлении/удалении записей"""
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def _walk_entries(top):
+    """
+    Обход дерева каталогов сверху вниз на os.scandir, как os.walk с
+    followlinks=True, но с DirEntry вместо имён: путь и тип записи берутся
+    из getdents без os.path.join и лишних stat. Выдаёт (каталог, подкаталоги,
+    файлы); список подкаталогов можно сортировать или очищать на месте
+    """
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        dirs = []
+        files = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            (dirs if is_dir else files).append(entry)
+        yield path, dirs, files
+        stack.extend(entry.path for entry in reversed(dirs))
+
+
+def _sendmsg_all(sock, buffers):
+    """Отправляет буферы одним scatter-gather вызовом, дописывая остаток при частичной отправке"""
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def _compile_file_pattern(pattern):
+    """
+    Возвращает fullmatch для file_pattern. По умолчанию это regex;
+    с префиксом "glob:" ("glob:*.mkv") остаток переводится в regex через fnmatch
+    """
+    if pattern.startswith("glob:"):
+        return re.compile(fnmatch.translate(pattern[5:])).fullmatch
+    return re.compile(pattern).fullmatch
+
+
+def _is_allowed_mpv_command(command):
+    """
+    Проверяет команду по белому списку _MPV_COMMANDS, а для команд,
+    меняющих свойства, - и имя свойства по _MPV_PROPERTIES. Разбор тот же,
+    что в send_mpv_commands, чтобы кавычки не обходили проверку
+    """
+    if not isinstance(command, str):
+        return False
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return False
+    if not args or args[0] not in _MPV_COMMANDS:
+        return False
+    if args[0] in _MPV_PROPERTY_COMMANDS:
+        return len(args) > 1 and args[1] in _MPV_PROPERTIES
+    return True
+
+
+def _inotify_watch_dir(path):
+    """inotify дескриптор, следящий за появлением файлов в каталоге, или None"""
+    if _inotify_init1 is None:
+        return None
+    fd = _inotify_init1(_IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if _inotify_add_watch(fd, os.fsencode(path), _IN_CREATE | _IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _wait_for_path(path, timeout, fd=None):
+    """
+    Ждёт появления файла не дольше timeout секунд. Через inotify просыпаемся
+    сразу по событию в каталоге; без inotify опрашиваем с растущей паузой.
+    Наблюдение ставится до проверки существования, поэтому гонки нет.
+    fd - наблюдение, заранее поставленное _inotify_watch_dir; закрывается здесь
+    """
+    deadline = time.monotonic() + timeout
+    if fd is None:
+        fd = _inotify_watch_dir(os.path.dirname(path) or ".")
+    try:
+        delay = 0.01
+        while not os.path.exists(path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if fd is None:
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.5)
+            elif select.select([fd], [], [], remaining)[0]:
+                # Сами события не разбираем - после пробуждения проверяем путь
+                os.read(fd, 4096)
+        return True
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+class PlayerState:
+    """
+    Состояние проигрывателя, публикуемое в MQTT. __slots__ задан вручную,
+    а не через dataclass(slots=True), чтобы работать на Python 3.9
+    """
+    __slots__ = ("state", "media_content_id", "media_title", "volume", "position", "duration")
+
+    def __init__(self):
+        self.state = "idle"
+        self.media_content_id = None
+        self.media_title = None
+        self.volume = 50
+        self.position = 0
+        self.duration = 0
+
+    def as_dict(self):
+        """Словарь для JSON в том же порядке ключей, что и раньше"""
+        return {
+            "state": self.state,
+            "media_content_id": self.media_content_id,
+            "media_title": self.media_title,
+            "volume": self.volume,
+            "position": self.position,
+            "duration": self.duration
+        }
+
 
 class MPVController:
     def __init__(self, config_path="./config.json"):
         self.config = self.load_config(config_path)
+        # Часто используемые параметры - атрибутами вместо вложенных словарей
+        mpv_cfg = self.config["mpv"]
+        self.socket_path = mpv_cfg["socket_path"]
+        self.media_dir = mpv_cfg["media_dir"]
+        self.playlist_file = mpv_cfg["playlist_file"]
+        self.playlist_path = os.path.join(self.media_dir, self.playlist_file)
         self.mpv_process = None
-        self.mpv_log_handle = None  # Add log file handle
+        self.mpv_pidfd = None  # pidfd процесса MPV (Linux 5.3+)
         self.playlist = []
+        # Имена файлов плейлиста по полному пути - для media_title без basename
+        self._basenames = {}
         self.is_playing = False
-        self.current_state = {
-            "state": "idle",
-            "media_content_id": None,
-            "media_title": None,
-            "volume": 50,
-            "position": 0,
-            "duration": 0
+        self.reset_start_on_load = False
+        self.current_state = PlayerState()
+        self.previous_state = PlayerState()
+        # Обработчики property-change по имени свойства
+        self._property_handlers = {
+            "pause": self._on_pause,
+            "path": self._on_path,
+            "time-pos": self._on_time_pos,
+            "duration": self._on_duration,
+            "volume": self._on_volume,
         }
-        self.previous_state = self.current_state.copy()
         self.ipc_socket = None
+        # Selector регистрирует IPC сокет один раз на соединение
+        self._ipc_selector = None
+        # Команды идут через то же соединение, что и события: ответы по
+        # request_id разбирает поток наблюдения и будит ожидающих
+        self._ipc_send_lock = threading.Lock()
+        self._ipc_waiters = {}
+        self._ipc_request_id = 0
         self.observation_thread = None
-        self.state_file_timer_thread = None
         self.stop_observation = False
-        self.stop_state_file_timer = False
+        # Файл состояния раз в секунду переписывает поток наблюдения:
+        # все записи идут из одного потока и не делят временный файл
+        self.state_file_updates = False
         self.state_changed = False
         self.last_publish_time = 0
         self.publish_interval = self.config["mqtt"].get("publish_interval", 1.0)  # секунды
 
+        # Шаблон медиафайлов компилируется один раз
+        self._file_re = _compile_file_pattern(mpv_cfg["file_pattern"])
+
         # State file path
-        self.state_file_path = os.path.join(
-            self.config["mpv"]["media_dir"],
-            "mpv_state.json"
-        )
+        self.state_file_path = os.path.join(self.media_dir, "mpv_state.json")
+
+        # Кэш плейлиста: сигнатура медиатеки на момент последнего сканирования
+        self._playlist_cache = None  # (плейлист, имена файлов) последнего сканирования
+        self._playlist_sig = None
+        self._playlist_dirs = []
+        self._playlist_digest = None  # хэш последнего записанного плейлиста
+        # Служебные файлы контроллера в media_dir, не влияющие на плейлист
+        own_files = [self.playlist_file, os.path.basename(self.state_file_path)]
+        log_config = mpv_cfg.get("mpv_log", "mpv.log")
+        if log_config and not os.path.isabs(log_config):
+            own_files.append(log_config)
+        self._own_files = frozenset(own_files + [f + ".tmp" for f in own_files])
 
     def load_config(self, path):
         try:
-            with open(path, "r") as f:
-                return json.load(f)
+            with open(path, "rb") as f:
+                return _jloads(f.read())
         except Exception as e:
             print(f"Config load error: {e}")
             raise SystemExit(1)
 
-    def natural_sort_key(self, s):
+    def get_playlist_path(self):
+        """Возвращает полный путь к плейлисту в папке media_dir"""
+        return self.playlist_path
+
+    def _root_names(self, entries):
+        """Имена записей корня медиатеки без служебных файлов контроллера"""
+        return frozenset(e.name for e in entries if e.name not in self._own_files)
+
+    def _media_signature(self, root_names):
         """
-        Генерирует ключ для естественной сортировки (natural sort)
+        Сигнатура медиатеки для ранее просканированных каталогов или None,
+        если какой-то из них пропал. Корень сравнивается по списку имён, т.к.
+        его mtime меняется при каждой записи файла состояния
         """
-        import re
-        return [int(text) if text.isdigit() else text.lower()
-                for text in re.split(r'(\d+)', s)]
+        try:
+            return root_names, tuple(_stat_sig(os.stat(d)) for d in self._playlist_dirs)
+        except OSError:
+            return None
 
-    def get_playlist_path(self):
-        """Возвращает полный путь к плейлисту в папке media_dir"""
-        return os.path.join(self.config["mpv"]["media_dir"], self.config["mpv"]["playlist_file"])
+    def write_playlist(self, playlist_path):
+        """
+        Записывает текущий плейлист атомарно через временный файл.
+        Если содержимое совпадает с последней записью и файл на месте,
+        запись пропускается
+        """
+        # Хэш считается по строкам, без склейки всего плейлиста в одну строку
+        h = hashlib.blake2b(digest_size=16)
+        for path in self.playlist:
+            h.update(path.encode())
+            h.update(b"\n")
+        digest = h.digest()
+        if digest == self._playlist_digest and os.path.exists(playlist_path):
+            return
+
+        temp_path = playlist_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8", buffering=1 << 20) as f:
+            f.writelines(path + "\n" for path in self.playlist)
+        os.replace(temp_path, playlist_path)
+        self._playlist_digest = digest
 
-    def prepare_playlist(self, force=False):
-        """Создаёт новый плейлист, если force=True или файла нет"""
+    def prepare_playlist(self, force=False, rescan=False):
+        """
+        Создаёт новый плейлист, если force=True или файла нет.
+        rescan=True - явная пересборка: кэш по сигнатуре каталогов не
+        используется, т.к. он не замечает, например, ставший доступным каталог
+        """
         playlist_path = self.get_playlist_path()
         if not force and os.path.exists(playlist_path):
             print(f"Using existing playlist: {playlist_path}")
             # Загружаем плейлист в память
             with open(playlist_path, "r") as f:
                 self.playlist = [line.strip() for line in f if line.strip()]
+            self._basenames = {path: os.path.basename(path) for path in self.playlist}
             return True
 
         try:
-            media_dir = self.config["mpv"]["media_dir"]
+            media_dir = self.media_dir
+            # Скомпилированный шаблон - в локальную переменную для циклов ниже
+            match = self._file_re
             if not os.path.exists(media_dir):
                 raise FileNotFoundError(f"Media directory {media_dir} not found")
 
-            # Получаем список файлов, соответствующих шаблону
-            # Сначала обрабатываем корневую директорию
-            root_files = []
-            for filename in os.listdir(media_dir):
-                file_path = os.path.join(media_dir, filename)
-                if os.path.isfile(file_path) or (os.path.islink(file_path) and not os.path.isdir(file_path)):
-                    if re.fullmatch(self.config["mpv"]["file_pattern"], filename):
-                        root_files.append(file_path)
+            # Один обход дерева: первым генератор выдаёт сам корень,
+            # scandir отдаёт тип записи из getdents без лишних stat
+            walker = _walk_entries(media_dir)
+            top = next(walker, None)
+            if top is None:
+                raise OSError(f"Cannot read media directory {media_dir}")
+            _, root_dirs, root_entries = top
+            root_names = self._root_names(root_dirs + root_entries)
+
+            # Содержимое не менялось с прошлого сканирования - берём плейлист из кэша
+            if (not rescan and self._playlist_sig is not None and
+                    self._media_signature(root_names) == self._playlist_sig):
+                self.playlist, self._basenames = self._playlist_cache
+                self.write_playlist(playlist_path)
+                print(f"Media directory unchanged, reusing cached playlist with {len(self.playlist)} files")
+                return True
+
+            # Сортируем поддиректории корня до продолжения обхода
+            root_dirs.sort(key=_entry_nat_key)
+            root_st = os.stat(media_dir)
+            visited_dirs = {(root_st.st_dev, root_st.st_ino)}
+
+            # (глубина, естественный ключ пути, путь): глубина 0 ставит файлы
+            # корня перед поддиректориями, весь список сортируется один раз
+            collected = [(0, _nat_key(entry.path), entry.path) for entry in root_entries
+                         if (entry.is_file() or entry.is_symlink()) and match(entry.name)]
+            # Имя файла уже есть в DirEntry - запоминаем его вместо basename
+            basenames = {entry.path: entry.name for entry in root_entries}
 
             # Затем рекурсивно обрабатываем поддиректории
-            subdir_files = []
-            visited_dirs = set()
-            for root, dirs, filenames in os.walk(media_dir, followlinks=True):
-                real_root = os.path.realpath(root)
-                if real_root in visited_dirs:
+            subdirs = []
+            subdir_sigs = []
+            for root, dirs, files in walker:
+                # Каталог опознаётся по (st_dev, st_ino): один stat вместо
+                # разрешения всех ссылок в realpath, и bind-mount/жёсткие
+                # ссылки на каталог тоже распознаются
+                try:
+                    st = os.stat(root)
+                except OSError:
+                    dirs[:] = []
+                    continue
+                dir_id = (st.st_dev, st.st_ino)
+                if dir_id in visited_dirs:
                     # Удаляем поддиректории чтобы избежать циклов
                     dirs[:] = []
                     continue
-                visited_dirs.add(real_root)
+                visited_dirs.add(dir_id)
 
-                # Пропускаем корневую директорию (уже обработали)
-                if root == media_dir:
-                    # Но все равно сортируем поддиректории для правильного порядка обхода
-                    dirs.sort(key=self.natural_sort_key)
-                    continue
+                subdirs.append(root)
+                subdir_sigs.append(_stat_sig(st))
 
-                # Сортируем директории и файлы для детерминированного порядка
-                dirs.sort(key=self.natural_sort_key)
-                filenames.sort(key=self.natural_sort_key)
+                # Порядок обхода поддиректорий детерминирован; файлы
+                # упорядочит общая сортировка ниже
+                dirs.sort(key=_entry_nat_key)
 
-                for filename in filenames:
-                    file_path = os.path.join(root, filename)
+                for entry in files:
                     # Проверяем соответствие паттерну
-                    if re.fullmatch(self.config["mpv"]["file_pattern"], filename):
-                        subdir_files.append(file_path)
+                    if match(entry.name):
+                        collected.append((1, _nat_key(entry.path), entry.path))
+                        basenames[entry.path] = entry.name
 
-            # Объединяем списки: сначала корневая, затем поддиректории
-            # Сортируем корневой список и список поддиректорий отдельно
-            root_sorted = sorted(root_files, key=self.natural_sort_key)
-            subdir_sorted = sorted(subdir_files, key=self.natural_sort_key)
-            files = root_sorted + subdir_sorted
+            collected.sort()
+            files = [path for _, _, path in collected]
 
             if not files:
                 print("No media files found matching the pattern")
                 return False
 
             self.playlist = files
+            self._basenames = {path: basenames[path] for path in files}
+            self._playlist_cache = (files, self._basenames)
+            self._playlist_dirs = subdirs
+            self._playlist_sig = (root_names, tuple(subdir_sigs))
 
-            with open(playlist_path, "w") as f:
-                f.write("\n".join(self.playlist))
+            self.write_playlist(playlist_path)
 
             print(f"Playlist created with {len(self.playlist)} files at {playlist_path}")
             return True
@@ -138,14 +446,34 @@ class MPVController:
         """Устанавливает соединение с IPC сокетом MPV"""
         try:
             self.ipc_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            self.ipc_socket.connect(self.config["mpv"]["socket_path"])
-            self.ipc_socket.setblocking(0)  # Неблокирующий режим
+            self.ipc_socket.connect(self.socket_path)
+            # Таймаут вместо неблокирующего режима: чтение идёт только после
+            # сигнала selector, а отправка команд дожидается места в буфере
+            self.ipc_socket.settimeout(1)
+            self.ipc_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+            self._ipc_selector = selectors.DefaultSelector()
+            self._ipc_selector.register(self.ipc_socket, selectors.EVENT_READ)
             print("Connected to MPV IPC socket")
             return True
         except Exception as e:
             print(f"Failed to connect to MPV IPC socket: {e}")
             return False
 
+    def _resolve_ipc_reply(self, reply, line):
+        """Передаёт ответ MPV отправителю команды; False, если его никто не ждёт"""
+        waiter = self._ipc_waiters.pop(reply.get("request_id"), None)
+        if waiter is None:
+            return False
+        waiter[1] = line.decode()
+        waiter[0].set()
+        return True
+
+    def _release_ipc_waiters(self):
+        """Будит всех ожидающих ответа - соединение с MPV закрыто"""
+        while self._ipc_waiters:
+            _, waiter = self._ipc_waiters.popitem()
+            waiter[0].set()
+
     def send_ipc_command(self, command):
         """Отправляет команду через IPC сокет"""
         if not self.ipc_socket:
@@ -153,7 +481,8 @@ class MPVController:
             return None
 
         try:
-            self.ipc_socket.send((command + "\n").encode())
+            with self._ipc_send_lock:
+                self.ipc_socket.sendall((command + "\n").encode())
             return True
         except Exception as e:
             print(f"Failed to send IPC command: {e}")
@@ -169,10 +498,18 @@ class MPVController:
             "volume"
         ]
 
-        for prop in properties:
-            cmd = f'{{"command": ["observe_property", 1, "{prop}"]}}'
-            if not self.send_ipc_command(cmd):
-                print(f"Failed to observe property: {prop}")
+        # Все команды уходят одним sendmsg вместо отдельного send на каждую
+        buffers = [f'{{"command": ["observe_property", 1, "{prop}"]}}\n'.encode()
+                   for prop in properties]
+        if not self.ipc_socket:
+            print("No IPC connection")
+            return
+        try:
+            with self._ipc_send_lock:
+                _sendmsg_all(self.ipc_socket, buffers)
+        except Exception as e:
+            print(f"Failed to observe properties: {e}")
+            return
 
         print("Property observation setup complete")
 
@@ -189,210 +526,303 @@ class MPVController:
 
     def observe_properties(self, callback):
         """Поток для наблюдения за изменениями свойств MPV"""
+        # Неполная строка остаётся в буфере до следующего recv, поэтому
+        # событие на границе двух чтений не теряется
+        buf = bytearray()
+        next_state_write = time.monotonic() + 1
         while not self.stop_observation and self.ipc_socket:
             try:
-                # Используем select для проверки доступности данных
-                ready = select.select([self.ipc_socket], [], [], 1.0)
-                if ready[0]:
-                    data = self.ipc_socket.recv(4096).decode()
-                    if data:
-                        for line in data.strip().split('\n'):
-                            if line:
-                                try:
-                                    event = json.loads(line)
-                                    self.process_event(event)
-                                    # Помечаем, что состояние изменилось
-                                    self.state_changed = True
-                                except json.JSONDecodeError:
-                                    print(f"Failed to parse JSON: {line}")
-                elif not self.is_playing:
-                    # Если MPV не воспроизводится, прекращаем наблюдение
-                    break
+                # Ждём данных на зарегистрированном заранее сокете
+                if self._ipc_selector.select(timeout=1.0):
+                    data = self.ipc_socket.recv(65536)
+                    if not data:
+                        # MPV закрыл соединение (процесс завершился). Без pidfd
+                        # об этом больше никто не узнает - снимаем признак
+                        # воспроизведения, чтобы следующий play перезапустил MPV
+                        self.is_playing = False
+                        break
+                    buf += data
+                    # Строки разбираются прямо из буфера, без decode;
+                    # обработанная часть удаляется одним срезом
+                    start = 0
+                    nl = buf.find(b"\n")
+                    try:
+                        while nl != -1:
+                            line = bytes(buf[start:nl])
+                            start = nl + 1
+                            nl = buf.find(b"\n", start)
+                            if not line:
+                                continue
+                            try:
+                                event = _jloads(line)
+                                # Ответ на команду из send_mpv_commands - не событие
+                                if "event" not in event and self._resolve_ipc_reply(event, line):
+                                    continue
+                                self.process_event(event)
+                                # Помечаем, что состояние изменилось
+                                self.state_changed = True
+                            except json.JSONDecodeError:
+                                print(f"Failed to parse JSON: {line.decode(errors='replace')}")
+                    finally:
+                        del buf[:start]
+
+                now = time.monotonic()
+                if now >= next_state_write:
+                    next_state_write = now + 1
+                    if self.state_file_updates and self.is_playing:
+                        self.update_state_file()
             except Exception as e:
                 print(f"Error in observation thread: {e}")
                 time.sleep(1)  # Пауза перед повторной попыткой
 
+        self._release_ipc_waiters()
         print("Property observation thread stopped")
 
     def process_event(self, event):
         """Обрабатывает события от MPV"""
-        if "event" in event and event["event"] == "property-change":
-            name = event.get("name")
-            data = event.get("data")
-
-            if name == "pause":
-                new_state = "paused" if data else "playing"
-                if self.current_state["state"] != new_state:
-                    self.current_state["state"] = new_state
-                    print(f"Playback state: {self.current_state['state']}")
-            elif name == "path" and data:
-                new_content_id = data
-                new_title = os.path.basename(data)
-                if (self.current_state["media_content_id"] != new_content_id or
-                    self.current_state["media_title"] != new_title):
-                    self.current_state["media_content_id"] = new_content_id
-                    self.current_state["media_title"] = new_title
-                    print(f"Now playing: {self.current_state['media_title']}")
-            elif name == "time-pos" and data is not None:
-                self.current_state["position"] = data
-            elif name == "duration" and data is not None:
-                self.current_state["duration"] = data
-            elif name == "volume" and data is not None:
-                self.current_state["volume"] = data
+        kind = event.get("event")
+        # MPV в режиме ожидания тоже шлёт события - вне воспроизведения
+        # учитываем только громкость: первый ответ на observe_property
+        # приходит до play, а потом MPV шлёт лишь изменения
+        if not self.is_playing:
+            if kind == "property-change" and event.get("name") == "volume":
+                self._on_volume(event.get("data"))
+            return
+
+        if kind == "property-change":
+            # Один поиск в словаре вместо цепочки сравнений имени свойства
+            handler = self._property_handlers.get(event.get("name"))
+            # False - изменение незначимо, файл состояния не переписываем
+            if handler and handler(event.get("data")) is False:
+                return
+        elif kind == "file-loaded" and self.reset_start_on_load:
+            # Позиция из файла состояния нужна только для первого файла
+            self.reset_start_on_load = False
+            self.send_ipc_command('{"command": ["set_property", "start", "none"]}')
 
         # Update state file after processing event
         self.update_state_file()
 
+    def _on_pause(self, data):
+        new_state = "paused" if data else "playing"
+        if self.current_state.state != new_state:
+            self.current_state.state = new_state
+            print(f"Playback state: {self.current_state.state}")
+
+    def _on_path(self, data):
+        if not data:
+            return
+        new_content_id = data
+        new_title = self._basenames.get(data) or os.path.basename(data)
+        if (self.current_state.media_content_id != new_content_id or
+            self.current_state.media_title != new_title):
+            self.current_state.media_content_id = new_content_id
+            self.current_state.media_title = new_title
+            print(f"Now playing: {self.current_state.media_title}")
+
+    def _on_time_pos(self, data):
+        # time-pos приходит много раз в секунду; сдвиги меньше 0.25 сек
+        # не дойдут до публикации (порог 0.5 сек) - отбрасываем их сразу
+        if data is None or abs(data - self.current_state.position) < 0.25:
+            return False
+        self.current_state.position = data
+
+    def _on_duration(self, data):
+        if data is not None:
+            self.current_state.duration = data
+
+    def _on_volume(self, data):
+        if data is not None:
+            self.current_state.volume = data
+
     def should_publish_state(self):
         """Проверяет, нужно ли публиковать состояние"""
         current_time = time.time()
 
         # Проверяем, изменилось ли состояние
         state_changed = (
-            self.current_state["state"] != self.previous_state["state"] or
-            self.current_state["media_content_id"] != self.previous_state["media_content_id"] or
-            self.current_state["media_title"] != self.previous_state["media_title"] or
-            abs(self.current_state["position"] - self.previous_state["position"]) > 0.5 or  # Позиция изменилась более чем на 0.5 сек
-            abs(self.current_state["volume"] - self.previous_state["volume"]) > 1 or  # Громкость изменилась более чем на 1%
+            self.current_state.state != self.previous_state.state or
+            self.current_state.media_content_id != self.previous_state.media_content_id or
+            self.current_state.media_title != self.previous_state.media_title or
+            abs(self.current_state.position - self.previous_state.position) > 0.5 or  # Позиция изменилась более чем на 0.5 сек
+            abs(self.current_state.volume - self.previous_state.volume) > 1 or  # Громкость изменилась более чем на 1%
             current_time - self.last_publish_time >= self.publish_interval
         )
 
         return state_changed
 
     def update_previous_state(self):
-        """Обновляет предыдущее состояние"""
-        self.previous_state = self.current_state.copy()
-
-    def start_mpv_drm(self, state_callback):
-        if self.mpv_process and self.mpv_process.poll() is None:
-            print("MPV is already running")
-            return True
-
-        playlist_path = self.get_playlist_path()
-        if not os.path.exists(playlist_path):
-            if not self.prepare_playlist(force=True):
-                print("Failed to create playlist for playback")
-                return False
+        """Обновляет предыдущее состояние полями, без создания нового объекта"""
+        current, previous = self.current_state, self.previous_state
+        previous.state = current.state
+        previous.media_content_id = current.media_content_id
+        previous.media_title = current.media_title
+        previous.volume = current.volume
+        previous.position = current.position
+        previous.duration = current.duration
+
+    def launch_mpv(self, state_callback):
+        """
+        Запускает долгоживущий MPV в режиме ожидания (--idle) и подключается
+        к его IPC. Плейлисты затем загружаются командами, без перезапуска
+        """
+        if self.mpv_process:
+            if self.mpv_process.poll() is None:
+                return True
+            # MPV завершился незамеченным (нет pidfd) - освобождаем его ресурсы
+            self.handle_mpv_exit()
 
         base_cmd = [
             "mpv",
-            f"--input-ipc-server={self.config['mpv']['socket_path']}",
+            f"--input-ipc-server={self.socket_path}",
             "--vo=drm",
             "--audio-device=alsa/default",
             "--no-input-default-bindings",
             "--no-input-cursor",
             "--profile=sw-fast",
-            f"--playlist={playlist_path}",
+            "--idle=yes",
+            "--force-window=no",
             "--loop-playlist"
         ]
 
         try:
             # Убедимся, что старый сокет удален
-            if os.path.exists(self.config["mpv"]["socket_path"]):
-                os.remove(self.config["mpv"]["socket_path"])
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
 
             # Handle log file configuration from mpv_log parameter
             log_config = self.config["mpv"].get("mpv_log", "mpv.log")
-            log_file = None
+            log_fd = None
 
-            if not log_config:
-                # If empty or None, use /dev/null
-                log_file = "/dev/null"
-            else:
+            # /dev/null открывать незачем - это то же, что DEVNULL
+            if log_config and log_config != os.devnull:
                 # Check if absolute path
                 if os.path.isabs(log_config):
                     log_file = log_config
                 else:
                     # Relative path - use media_dir as root
-                    log_file = os.path.join(self.config["mpv"]["media_dir"], log_config)
+                    log_file = os.path.join(self.media_dir, log_config)
 
-            try:
-                # Try to open log file
-                self.mpv_log_handle = open(log_file, "a")
-            except Exception as e:
-                print(f"Failed to open log file '{log_file}': {e}. Redirecting to /dev/null")
-                log_file = "/dev/null"
                 try:
-                    self.mpv_log_handle = open(log_file, "a")
-                except Exception as e2:
-                    print(f"Critical error opening /dev/null: {e2}. Logging disabled.")
-                    self.mpv_log_handle = None
-
-            self.mpv_process = subprocess.Popen(
-                base_cmd,
-                stdout=self.mpv_log_handle,
-                stderr=self.mpv_log_handle,
-                start_new_session=True
-            )
+                    # MPV пишет прямо в дескриптор в режиме O_APPEND, без буферов Python;
+                    # O_CLOEXEC - в MPV он попадёт только как stdout, не лишним fd
+                    log_fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o666)
+                except OSError as e:
+                    print(f"Failed to open log file '{log_file}': {e}. Redirecting to /dev/null")
+
+            # If empty or unavailable, discard output
+            log_target = subprocess.DEVNULL if log_fd is None else log_fd
+            # Наблюдение за каталогом сокета ставим до запуска MPV, чтобы
+            # ожидание началось с уже готовым inotify
+            socket_watch = _inotify_watch_dir(os.path.dirname(self.socket_path) or ".")
+            try:
+                self.mpv_process = subprocess.Popen(
+                    base_cmd,
+                    stdout=log_target,
+                    # stderr - копия stdout, отдельный дескриптор лога не нужен
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True
+                )
+            except BaseException:
+                if socket_watch is not None:
+                    os.close(socket_watch)
+                raise
+            finally:
+                # У MPV своя копия дескриптора
+                if log_fd is not None:
+                    os.close(log_fd)
+            self.open_mpv_pidfd()
 
             # Ждем, пока сокет станет доступен
-            socket_wait_time = 0
-            while not os.path.exists(self.config["mpv"]["socket_path"]) and socket_wait_time < 10:
-                time.sleep(0.5)
-                socket_wait_time += 0.5
-
-            if not os.path.exists(self.config["mpv"]["socket_path"]):
+            if not _wait_for_path(self.socket_path, 10, socket_watch):
                 print("MPV socket not created after 10 seconds")
+                self.stop_mpv()
                 return False
 
             # Настраиваем IPC соединение и наблюдение
-            if self.setup_ipc_connection():
-                self.is_playing = True
-                self.current_state["state"] = "playing"
-                self.current_state["media_content_id"] = self.playlist[0] if self.playlist else None
-                self.current_state["media_title"] = os.path.basename(self.playlist[0]) if self.playlist else None
+            if not self.setup_ipc_connection():
+                print("Failed to setup IPC connection")
+                self.stop_mpv()
+                return False
+
+            self.setup_property_observation()
+            self.start_observation_thread(state_callback)
+            print("MPV started in idle mode")
+            return True
 
-                self.setup_property_observation()
-                self.start_observation_thread(state_callback)
+        except Exception as e:
+            print(f"MPV start failed: {e}")
+            return False
 
-                # Apply saved state if available
-                if os.path.exists(self.state_file_path):
-                    try:
-                        with open(self.state_file_path, "r") as f:
-                            state_data = json.load(f)
+    def start_mpv_drm(self, state_callback):
+        """Загружает плейлист в запущенный (или запускаемый) MPV и начинает воспроизведение"""
+        # Без pidfd выход MPV мог остаться незамеченным - проверяем процесс
+        if self.is_playing and not self.handle_mpv_exit():
+            print("MPV is already playing")
+            return True
+
+        playlist_path = self.get_playlist_path()
+        if not os.path.exists(playlist_path):
+            if not self.prepare_playlist(force=True):
+                print("Failed to create playlist for playback")
+                return False
+
+        if not self.launch_mpv(state_callback):
+            return False
+
+        try:
+            self.is_playing = True
+            self.current_state.state = "playing"
+            self.current_state.media_content_id = self.playlist[0] if self.playlist else None
+            self.current_state.media_title = self._basenames.get(self.playlist[0]) if self.playlist else None
 
-                        # Set volume from state
-                        vol_cmd = json.dumps({
-                            "command": ["set_property", "volume", state_data["volume"]]
+            pause = False
+
+            # Apply saved state if available
+            if os.path.exists(self.state_file_path):
+                try:
+                    with open(self.state_file_path, "r") as f:
+                        state_data = json.load(f)
+
+                    # Set volume from state
+                    vol_cmd = json.dumps({
+                        "command": ["set_property", "volume", state_data["volume"]]
+                    })
+                    self.send_ipc_command(vol_cmd)
+
+                    # If playing same file, start it from the saved position.
+                    # Файл ещё не загружен, поэтому задаём опцию start
+                    # и сбрасываем её по событию file-loaded
+                    if state_data["file"] == self.current_state.media_content_id:
+                        start_cmd = json.dumps({
+                            "command": ["set_property", "start", str(state_data["position"])]
                         })
-                        self.send_ipc_command(vol_cmd)
-
-                        # If playing same file, set position
-                        if state_data["file"] == self.current_state["media_content_id"]:
-                            seek_cmd = json.dumps({
-                                "command": ["set_property", "time-pos", state_data["position"]]
-                            })
-                            self.send_ipc_command(seek_cmd)
-
-                        # Apply playback state last (must be after position/volume)
-                        if state_data["state"] == "paused":
-                            pause_cmd = json.dumps({
-                                "command": ["set_property", "pause", True]
-                            })
-                            self.send_ipc_command(pause_cmd)
-                        elif state_data["state"] == "playing":
-                            pause_cmd = json.dumps({
-                                "command": ["set_property", "pause", False]
-                            })
-                            self.send_ipc_command(pause_cmd)
-
-                        print("Applied saved state from", self.state_file_path)
-                    except Exception as e:
-                        print(f"Error applying saved state: {e}")
+                        self.send_ipc_command(start_cmd)
+                        self.reset_start_on_load = True
 
-                # Start state file update timer
-                self.start_state_file_timer()
+                    # Playback state is set before loading so a paused
+                    # session does not start playing for a moment
+                    pause = state_data["state"] == "paused"
 
-                print("MPV started successfully with property observation")
-                return True
-            else:
-                print("Failed to setup IPC connection")
-                return False
+                    print("Applied saved state from", self.state_file_path)
+                except Exception as e:
+                    print(f"Error applying saved state: {e}")
+
+            load_cmd = json.dumps({"command": ["loadlist", playlist_path, "replace"]})
+            pause_cmd = json.dumps({"command": ["set_property", "pause", pause]})
+            if not (self.send_ipc_command(pause_cmd) and self.send_ipc_command(load_cmd)):
+                raise ConnectionError("failed to send playlist to MPV")
+
+            # Start periodic state file updates
+            self.start_state_file_updates()
+
+            print("MPV started successfully with property observation")
+            return True
 
         except Exception as e:
             print(f"MPV start failed: {e}")
             self.is_playing = False
-            self.current_state["state"] = "idle"
+            self.current_state.state = "idle"
             return False
 
     def update_state_file(self):
@@ -407,10 +837,10 @@ class MPVController:
             return
 
         state_data = {
-            "file": self.current_state["media_content_id"],
-            "position": self.current_state["position"],
-            "volume": self.current_state["volume"],
-            "state": self.current_state["state"]
+            "file": self.current_state.media_content_id,
+            "position": self.current_state.position,
+            "volume": self.current_state.volume,
+            "state": self.current_state.state
         }
 
         try:
@@ -422,25 +852,78 @@ class MPVController:
         except Exception as e:
             print(f"Error updating state file: {e}")
 
-    def start_state_file_timer(self):
-        """Starts timer to update state file every second"""
-        self.stop_state_file_timer = False
-        def timer_task():
-            while not self.stop_state_file_timer:
-                self.update_state_file()
-                time.sleep(1)
+    def start_state_file_updates(self):
+        """Enables state file updates every second on the observation thread"""
+        self.state_file_updates = True
+        print("Started state file updates")
+
+    def open_mpv_pidfd(self):
+        """Открывает pidfd запущенного MPV; без поддержки ядра остаётся None"""
+        self.close_mpv_pidfd()
+        try:
+            self.mpv_pidfd = os.pidfd_open(self.mpv_process.pid)
+        except (AttributeError, OSError):
+            self.mpv_pidfd = None
+
+    def close_mpv_pidfd(self):
+        if self.mpv_pidfd is not None:
+            os.close(self.mpv_pidfd)
+            self.mpv_pidfd = None
+
+    def wait_mpv_exit(self, timeout):
+        """
+        Ждёт завершения MPV. pidfd становится читаемым при выходе процесса,
+        поэтому ждём одним poll вместо циклического опроса в Popen.wait(timeout)
+        """
+        if self.mpv_pidfd is None:
+            return self.mpv_process.wait(timeout=timeout)
+
+        with selectors.DefaultSelector() as sel:
+            sel.register(self.mpv_pidfd, selectors.EVENT_READ)
+            if not sel.select(timeout):
+                raise subprocess.TimeoutExpired(self.mpv_process.args, timeout)
+        # Процесс уже завершён - wait() только забирает код возврата
+        return self.mpv_process.wait()
+
+    def handle_mpv_exit(self):
+        """
+        Обрабатывает самостоятельное завершение процесса MPV: освобождает
+        ресурсы и сбрасывает состояние. Возвращает True, если MPV завершился
+        """
+        if not self.mpv_process or self.mpv_process.poll() is None:
+            return False
+        print(f"MPV exited with code {self.mpv_process.returncode}")
+        self.stop_mpv()
+        return True
+
+    def stop_state_file_updates(self):
+        # Stop periodic state file updates
+        if self.state_file_updates:
+            self.state_file_updates = False
+            print("Stopped state file updates")
 
-        self.state_file_timer_thread = threading.Thread(target=timer_task)
-        self.state_file_timer_thread.daemon = True
-        self.state_file_timer_thread.start()
-        print("Started state file update timer")
+    def reset_state(self):
+        self.is_playing = False
+        self.current_state.state = "idle"
+        self.current_state.media_content_id = None
+        self.current_state.media_title = None
+        self.current_state.position = 0
+        self.current_state.duration = 0
+
+    def stop_playback(self):
+        """Останавливает воспроизведение, оставляя MPV запущенным в режиме ожидания"""
+        self.stop_state_file_updates()
+        if not self.is_playing:
+            return
+        # Сначала сбрасываем состояние, чтобы события MPV после stop игнорировались
+        self.reset_state()
+        if not self.send_ipc_command('{"command": ["stop"]}'):
+            # IPC недоступен - MPV в неизвестном состоянии, перезапустим при следующем play
+            self.stop_mpv()
 
     def stop_mpv(self):
-        # Stop state file timer
-        self.stop_state_file_timer = True
-        if self.state_file_timer_thread and self.state_file_timer_thread.is_alive():
-            self.state_file_timer_thread.join(timeout=1.0)
-            print("Stopped state file update timer")
+        """Полностью завершает процесс MPV"""
+        self.stop_state_file_updates()
 
         # Останавливаем наблюдение
         self.stop_observation = True
@@ -449,18 +932,26 @@ class MPVController:
             self.observation_thread.join(timeout=2.0)
 
         # Закрываем IPC соединение
+        if self._ipc_selector:
+            try:
+                self._ipc_selector.unregister(self.ipc_socket)
+            except (KeyError, ValueError):
+                pass
+            self._ipc_selector.close()
+            self._ipc_selector = None
         if self.ipc_socket:
             try:
                 self.ipc_socket.close()
             except:
                 pass
             self.ipc_socket = None
+        self._release_ipc_waiters()
 
         # Останавливаем процесс MPV
         if self.mpv_process:
             try:
                 self.mpv_process.terminate()
-                self.mpv_process.wait(timeout=5)
+                self.wait_mpv_exit(timeout=5)
                 print("MPV stopped successfully")
             except subprocess.TimeoutExpired:
                 self.mpv_process.kill()
@@ -469,32 +960,55 @@ class MPVController:
                 print(f"Error stopping MPV: {e}")
 
             self.mpv_process = None
-            self.is_playing = False
-            self.current_state["state"] = "idle"
-            self.current_state["media_content_id"] = None
-            self.current_state["media_title"] = None
-            self.current_state["position"] = 0
-            self.current_state["duration"] = 0
-
-            # Close log file if open
-            if self.mpv_log_handle:
-                self.mpv_log_handle.close()
-                self.mpv_log_handle = None
+            self.close_mpv_pidfd()
+            self.reset_state()
 
     def send_mpv_command(self, command):
+        return self.send_mpv_commands([command])[0]
+
+    def send_mpv_commands(self, commands):
+        """
+        Отправляет пакет команд одним sendmsg и возвращает ответы в том же
+        порядке (None для неотправленных). Ответы сопоставляются по request_id
+        """
+        responses = [None] * len(commands)
         if not self.is_playing:
             print("MPV is not running, cannot send command")
-            return None
+            return responses
 
+        pending = {}
+        buffers = []
+        for index, command in enumerate(commands):
+            try:
+                args = shlex.split(command)
+            except ValueError as e:
+                print(f"Invalid MPV command '{command}': {e}")
+                continue
+            self._ipc_request_id += 1
+            pending[self._ipc_request_id] = index
+            buffers.append((json.dumps({"command": args, "request_id": self._ipc_request_id}) + "\n").encode())
+
+        if not pending or not self.ipc_socket:
+            return responses
+
+        # Ожидающих регистрируем до отправки: ответ может прийти раньше,
+        # чем отправка вернёт управление
+        waiters = {request_id: [threading.Event(), None] for request_id in pending}
+        self._ipc_waiters.update(waiters)
         try:
-            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
-                sock.settimeout(1)
-                sock.connect(self.config["mpv"]["socket_path"])
-                sock.send((command + "\n").encode())
-                return sock.recv(1024).decode().strip()
+            with self._ipc_send_lock:
+                _sendmsg_all(self.ipc_socket, buffers)
+            deadline = time.monotonic() + 1
+            for request_id, waiter in waiters.items():
+                if not waiter[0].wait(max(deadline - time.monotonic(), 0)):
+                    raise TimeoutError("timed out waiting for MPV reply")
+                responses[pending[request_id]] = waiter[1]
         except Exception as e:
             print(f"IPC error: {e}")
-            return None
+            # Поздние ответы на эти команды просто отбрасываются
+            for request_id in waiters:
+                self._ipc_waiters.pop(request_id, None)
+        return responses
 
     def handle_play_command(self, state_callback):
         print("Received play command")
@@ -504,133 +1018,232 @@ class MPVController:
 
     def handle_stop_command(self):
         print("Received stop command")
-        self.stop_mpv()
+        self.stop_playback()
         return True
 
 class MQTTClient:
     def __init__(self, controller):
+        # paho импортируется только при создании клиента: построению
+        # плейлиста и управлению MPV он не нужен
+        import paho.mqtt.client as mqtt
+
         self.controller = controller
-        self.client = mqtt.Client()
+        mqtt_cfg = self.controller.config["mqtt"]
+        # Версия протокола из конфига: 4 - MQTT 3.1.1, 5 - MQTT 5.0
+        self.protocol = mqtt_cfg.get("protocol", mqtt.MQTTv311)
+        # Команды - fire-and-forget: чистая сессия без сохранения подписок на брокере.
+        # В MQTT 5 вместо clean_session используется clean_start при подключении
+        if self.protocol == mqtt.MQTTv5:
+            self.client = mqtt.Client(protocol=mqtt.MQTTv5)
+        else:
+            self.client = mqtt.Client(clean_session=True, protocol=self.protocol)
         self.client.on_message = self.on_message
         self.client.on_connect = self.on_connect
+        # Сеть paho обслуживается собственным циклом событий (см. loop)
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
 
         # Получаем полные имена топиков из конфига
-        mqtt_cfg = self.controller.config["mqtt"]
         self.control_topic = f"{mqtt_cfg['base_topic']}{mqtt_cfg['control_topic']}"
         self.state_topic = f"{mqtt_cfg['base_topic']}{mqtt_cfg['state_topic']}"
+        # QoS 0 не ждёт PUBACK на каждое сообщение; 1/2 - по желанию в конфиге
+        self.qos = mqtt_cfg.get("qos", 0)
+        if self.qos > 0:
+            # Одно неподтверждённое сообщение в полёте: устаревшие обновления
+            # состояния не копятся в очереди paho. На QoS 0 не влияет
+            self.client.max_inflight_messages_set(1)
+
+        # Последний отправленный payload состояния - повторы не публикуем
+        self._last_payload = None
+
+        # Один epoll на сокет MQTT, pidfd процесса MPV и pipe пробуждения
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, "wakeup")
+        self._watched_mpv = (None, None)
+        self._reconnect_delay = 1
+        self._stop_event = threading.Event()
+
+        # Собственные команды контроллера; остальные пересылаются в MPV
+        self._handlers = {
+            "play": self._do_play,
+            "stop": self._do_stop,
+            "clear-playlist": self._do_clear_playlist,
+        }
+
+    def _on_socket_open(self, client, userdata, sock):
+        # Вызывается и при каждом переподключении. Без Nagle короткие
+        # MQTT пакеты уходят сразу, а не ждут ACK предыдущих
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if hasattr(socket, "TCP_QUICKACK"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        except OSError as e:
+            print(f"Failed to set MQTT socket options: {e}")
+        self._selector.register(sock, selectors.EVENT_READ, "mqtt")
+
+    def _on_socket_close(self, client, userdata, sock):
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
 
-        # Таймер для периодической проверки состояния
-        self.publish_timer = None
+    def _on_socket_register_write(self, client, userdata, sock):
+        # Публикация может прийти из другого потока: будим цикл,
+        # он сам выставит интерес к записи по want_write()
+        self._wakeup()
 
-    def on_connect(self, client, userdata, flags, rc):
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    # Обращения к брокеру идут только через publish/subscribe и loop/run,
+    # чтобы MQTT-библиотеку можно было заменить, не трогая обработку команд
+    def publish(self, topic, payload, retain=False):
+        return self.client.publish(topic, payload, qos=self.qos, retain=retain)
+
+    def subscribe(self, topic):
+        return self.client.subscribe(topic, qos=self.qos)
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
             print("Connected to MQTT broker successfully")
+            self._reconnect_delay = 1
             # Подписываемся на топик управления
-            self.client.subscribe(self.control_topic)
+            self.subscribe(self.control_topic)
             print(f"Subscribed to control topic: {self.control_topic}")
             print(f"State will be published to: {self.state_topic}")
 
             # Публикуем начальное состояние при подключении
-            self.publish_state(self.controller.current_state)
-
-            # Запускаем таймер для периодической проверки состояния
-            self.start_publish_timer()
+            self.publish_state(self.controller.current_state, force=True)
         else:
             print(f"Failed to connect to MQTT broker with code: {rc}")
 
-    def start_publish_timer(self):
-        """Запускает таймер для периодической публикации состояния"""
-        if self.publish_timer:
-            self.publish_timer.cancel()
-
-        self.publish_timer = threading.Timer(0.5, self.check_and_publish_state)  # Проверяем каждые 0.5 сек
-        self.publish_timer.daemon = True
-        self.publish_timer.start()
-
     def check_and_publish_state(self):
         """Проверяет, нужно ли публиковать состояние, и публикует если нужно"""
         try:
             if self.controller.is_playing and self.controller.should_publish_state():
-                self.publish_state(self.controller.current_state)
+                # Раз в publish_interval публикуем даже неизменённое состояние (keepalive)
+                keepalive = time.time() - self.controller.last_publish_time >= self.controller.publish_interval
+                self.publish_state(self.controller.current_state, force=keepalive)
                 self.controller.update_previous_state()
                 self.controller.last_publish_time = time.time()
         except Exception as e:
-            print(f"Error in publish timer: {e}")
-
-        # Перезапускаем таймер
-        self.start_publish_timer()
+            print(f"Error in state publish check: {e}")
 
-    def publish_state(self, state):
-        """Публикует текущее состояние проигрывателя"""
+    def publish_state(self, state, force=False):
+        """
+        Публикует текущее состояние проигрывателя. Payload, совпадающий с
+        последним отправленным, пропускается, если не задан force
+        """
         try:
-            self.client.publish(
-                self.state_topic,
-                json.dumps(state),
-                retain=True
-            )
+            payload = _jdumps(state.as_dict())
+            if not force and payload == self._last_payload:
+                return
+            self.publish(self.state_topic, payload, retain=True)
+            self._last_payload = payload
             # print(f"State published to {self.state_topic}: {state['state']}, position: {state.get('position', 0):.1f}s")
         except Exception as e:
             print(f"Error publishing state: {e}")
 
-    def on_message(self, client, userdata, msg):
-        try:
-            payload = json.loads(msg.payload.decode())
-            command = payload.get("command", "").lower()
-
-            if command == "play":
-                if self.controller.handle_play_command(self.publish_state):
-                    print("Playback started successfully")
-                    # Принудительно публикуем состояние после запуска
-                    self.publish_state(self.controller.current_state)
-                    self.controller.update_previous_state()
-                    self.controller.last_publish_time = time.time()
-                else:
-                    print("Failed to start playback")
+    def _do_play(self):
+        if self.controller.handle_play_command(self.publish_state):
+            print("Playback started successfully")
+            # Принудительно публикуем состояние после запуска
+            self.publish_state(self.controller.current_state, force=True)
+            self.controller.update_previous_state()
+            self.controller.last_publish_time = time.time()
+        else:
+            print("Failed to start playback")
+
+    def _do_stop(self):
+        self.controller.handle_stop_command()
+        print("Playback stopped")
+        # Принудительно публикуем состояние после остановки
+        self.publish_state(self.controller.current_state, force=True)
+        self.controller.update_previous_state()
+        self.controller.last_publish_time = time.time()
+
+    def _do_clear_playlist(self):
+        print("Received clear-playlist command")
+        self.controller.stop_playback()
+        playlist_path = self.controller.get_playlist_path()
+        if os.path.exists(playlist_path):
+            try:
+                os.remove(playlist_path)
+                print(f"Old playlist removed: {playlist_path}")
 
-            elif command == "stop":
-                self.controller.handle_stop_command()
-                print("Playback stopped")
-                # Принудительно публикуем состояние после остановки
-                self.publish_state(self.controller.current_state)
+                # Also clear state file when playlist is updated
+                state_file = self.controller.state_file_path
+                if os.path.exists(state_file):
+                    try:
+                        os.remove(state_file)
+                        print(f"State file cleared: {state_file}")
+                    except Exception as e:
+                        print(f"Failed to remove state file: {e}")
+            except Exception as e:
+                print(f"Failed to remove playlist: {e}")
+        if self.controller.prepare_playlist(force=True, rescan=True):
+            if self.controller.start_mpv_drm(self.publish_state):
+                print("Playlist cleared and playback restarted")
+                self.publish_state(self.controller.current_state, force=True)
                 self.controller.update_previous_state()
                 self.controller.last_publish_time = time.time()
+            else:
+                print("Failed to restart playback after clearing playlist")
+        else:
+            print("Failed to prepare new playlist")
 
-            elif command == "clear-playlist":
-                print("Received clear-playlist command")
-                self.controller.stop_mpv()
-                playlist_path = self.controller.get_playlist_path()
-                if os.path.exists(playlist_path):
-                    try:
-                        os.remove(playlist_path)
-                        print(f"Old playlist removed: {playlist_path}")
+    def forward_commands(self, commands):
+        """Пересылает команды в MPV"""
+        # Отправляем команды только если MPV запущен
+        if not commands or not self.controller.is_playing:
+            print(f"Ignoring commands {commands} - MPV not running or invalid command")
+            return
 
-                        # Also clear state file when playlist is updated
-                        state_file = os.path.join(self.controller.config["mpv"]["media_dir"], "mpv_state.json")
-                        if os.path.exists(state_file):
-                            try:
-                                os.remove(state_file)
-                                print(f"State file cleared: {state_file}")
-                            except Exception as e:
-                                print(f"Failed to remove state file: {e}")
-                    except Exception as e:
-                        print(f"Failed to remove playlist: {e}")
-                if self.controller.prepare_playlist(force=True):
-                    if self.controller.start_mpv_drm(self.publish_state):
-                        print("Playlist cleared and playback restarted")
-                        self.publish_state(self.controller.current_state)
-                        self.controller.update_previous_state()
-                        self.controller.last_publish_time = time.time()
-                    else:
-                        print("Failed to restart playback after clearing playlist")
-                else:
-                    print("Failed to prepare new playlist")
-
-            elif command and self.controller.is_playing:
-                # Отправляем команды только если MPV запущен
-                if response := self.controller.send_mpv_command(command):
-                    print(f"Executed: {command} → {response}")
-                    # После команды небольшая задержка для обновления состояния
-                    time.sleep(0.1)
+        allowed = []
+        for command in commands:
+            if _is_allowed_mpv_command(command):
+                allowed.append(command)
+            else:
+                print(f"Ignoring command '{command}' - not an allowed MPV command")
+        if not allowed:
+            return
+
+        executed = False
+        for command, response in zip(allowed, self.controller.send_mpv_commands(allowed)):
+            if response:
+                print(f"Executed: {command} → {response}")
+                executed = True
+        if executed:
+            # После команды небольшая задержка для обновления состояния
+            time.sleep(0.1)
+
+    def on_message(self, client, userdata, msg):
+        try:
+            raw = msg.payload.strip()
+            if raw.startswith(b"{"):
+                command = _jloads(raw).get("command", "")
+            else:
+                # Текстовая команда ("play", "seek 10") - без разбора JSON
+                command = raw.decode()
+            if isinstance(command, list):
+                # Список команд MPV отправляется одним пакетом
+                self.forward_commands(command)
+                return
+
+            # Команды MPV пересылаются как есть (в них бывают пути и текст);
+            # регистр игнорируется только для собственных команд контроллера
+            handler = self._handlers.get(command)
+            if handler is None and not command.islower():
+                handler = self._handlers.get(command.lower())
+            if handler:
+                handler()
+            elif command:
+                self.forward_commands([command])
             else:
                 print(f"Ignoring command '{command}' - MPV not running or invalid command")
 
@@ -650,12 +1263,16 @@ class MQTTClient:
             )
             print(f"Using MQTT authentication for user: {mqtt_cfg['username']}")
 
+        # SIGTERM (systemd stop) завершает цикл так же, как Ctrl+C
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
         try:
-            self.client.connect(mqtt_cfg["broker"], mqtt_cfg["port"])
+            # Само подключение выполняет loop(): недоступный брокер не
+            # завершает процесс, а переподключается с растущей паузой
+            self.client.connect_async(mqtt_cfg["broker"], mqtt_cfg["port"], clean_start=True)
             print(f"Connecting to MQTT at {mqtt_cfg['broker']}:{mqtt_cfg['port']}")
 
-            # Запускаем фоновый цикл MQTT
-            self.client.loop_forever()
+            self.loop()
 
         except Exception as e:
             print(f"MQTT connection error: {e}")
@@ -663,12 +1280,102 @@ class MQTTClient:
         except KeyboardInterrupt:
             print("MQTT loop interrupted")
         finally:
-            if self.publish_timer:
-                self.publish_timer.cancel()
+            self._stop_event.set()
+
+    def loop(self):
+        """
+        Цикл событий основного потока вместо loop_forever: один select
+        обслуживает сокет MQTT (чтение/запись paho), pidfd запущенного MPV
+        и pipe пробуждения. Каждые 0.5 сек проверяется, нужно ли публиковать
+        состояние, раз в секунду вызывается loop_misc
+        """
+        last_misc = time.monotonic()
+        next_publish = last_misc + 0.5
+        reconnect_at = 0
+        while not self._stop_event.is_set():
+            self._watch_mpv_process()
+
+            sock = self.client.socket()
+            if sock is None:
+                # Соединение потеряно - переподключаемся с растущей паузой
+                if time.monotonic() >= reconnect_at:
+                    reconnect_at = time.monotonic() + self._reconnect()
+            else:
+                events = selectors.EVENT_READ
+                if self.client.want_write():
+                    events |= selectors.EVENT_WRITE
+                if self._selector.get_key(sock).events != events:
+                    self._selector.modify(sock, events, "mqtt")
+
+            timeout = max(min(next_publish, last_misc + 1.0) - time.monotonic(), 0)
+            for key, events in self._selector.select(timeout=timeout):
+                if key.data == "mqtt":
+                    if events & selectors.EVENT_READ:
+                        self.client.loop_read()
+                    if events & selectors.EVENT_WRITE and self.client.socket() is key.fileobj:
+                        self.client.loop_write()
+                elif key.data == "mpv":
+                    self._mpv_exited()
+                else:
+                    try:
+                        os.read(self._wakeup_r, 4096)
+                    except BlockingIOError:
+                        pass
+
+            now = time.monotonic()
+            if now >= next_publish:
+                next_publish = now + 0.5
+                if self.client.is_connected():
+                    self.check_and_publish_state()
+            if now - last_misc >= 1.0:
+                self.client.loop_misc()
+                last_misc = now
+
+    def _reconnect(self):
+        """Пытается переподключиться к брокеру; возвращает паузу до следующей попытки"""
+        # Пауза растёт и при удачном TCP подключении: брокер ещё может
+        # отказать в CONNACK. Сбрасывается только в on_connect при rc == 0
+        delay = self._reconnect_delay
+        self._reconnect_delay = min(delay * 2, 60)
+        try:
+            self.client.reconnect()
+        except OSError as e:
+            print(f"MQTT reconnect failed: {e}. Retrying in {delay}s")
+        return delay
+
+    def _watch_mpv_process(self):
+        """Следит за pidfd текущего процесса MPV, если он сменился"""
+        process = self.controller.mpv_process
+        watched = (process, self.controller.mpv_pidfd if process else None)
+        if watched == self._watched_mpv:
+            return
+        if self._watched_mpv[1] is not None:
+            try:
+                self._selector.unregister(self._watched_mpv[1])
+            except KeyError:
+                pass
+        if watched[1] is not None:
+            self._selector.register(watched[1], selectors.EVENT_READ, "mpv")
+        self._watched_mpv = watched
+
+    def _mpv_exited(self):
+        """pidfd стал читаемым - MPV завершился без команды stop"""
+        if self.controller.handle_mpv_exit():
+            self.publish_state(self.controller.current_state)
+            self.controller.update_previous_state()
+            self.controller.last_publish_time = time.time()
+        self._watch_mpv_process()
+
+    def stop(self):
+        """Завершает run() из любого потока"""
+        self._stop_event.set()
+        self._wakeup()
 
 if __name__ == "__main__":
     try:
         controller = MPVController()
+        # MPV запускается один раз и ждёт команд в режиме ожидания
+        controller.launch_mpv(lambda state: None)
 
         # Auto-start if state file and playlist exist
         playlist_path = controller.get_playlist_path()